@@ -0,0 +1,109 @@
+import numpy as np
+
+try:
+    from numba import get_num_threads, njit, prange
+except ImportError:
+    njit = None
+
+# Fewest scores per parallel block
+MIN_BLOCK_SIZE = 8192
+
+def _topk_numpy(scores: np.ndarray, k: int) -> np.ndarray:
+    """argpartition finds the top k in O(N); only those k are then sorted."""
+    top = np.argpartition(scores, -k)[-k:]
+    return top[np.argsort(scores[top])[::-1]]
+
+if njit is not None:
+    @njit(cache=True)
+    def _sift_down(values, indices, pos, size):
+        """Restore the min-heap property below pos."""
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                return
+            if child + 1 < size and values[child + 1] < values[child]:
+                child += 1
+            if values[child] >= values[pos]:
+                return
+            values[pos], values[child] = values[child], values[pos]
+            indices[pos], indices[child] = indices[child], indices[pos]
+            pos = child
+
+    @njit(cache=True)
+    def _heap_topk(scores, ids, start, stop, k, values, indices):
+        """Keep the k largest of scores[start:stop] in a bounded min-heap; returns its size."""
+        size = 0
+        for i in range(start, stop):
+            score = scores[i]
+            if size < k:
+                values[size] = score
+                indices[size] = ids[i]
+                size += 1
+                if size == k:
+                    for pos in range(k // 2 - 1, -1, -1):
+                        _sift_down(values, indices, pos, k)
+            elif score > values[0]:
+                values[0] = score
+                indices[0] = ids[i]
+                _sift_down(values, indices, 0, k)
+        return size
+
+    @njit(cache=True)
+    def _topk_serial(scores, k):
+        """Single bounded heap over all scores, skipping the parallel launch."""
+        values = np.empty(k, scores.dtype)
+        indices = np.empty(k, np.int64)
+        _heap_topk(scores, np.arange(scores.shape[0]), 0, scores.shape[0], k, values, indices)
+        return indices[np.argsort(-values)]
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _topk_numba(scores, k, n_blocks):
+        """Per-block heaps filled in parallel, then merged into one heap of k."""
+        n = scores.shape[0]
+        ids = np.arange(n)
+        block_values = np.empty((n_blocks, k), scores.dtype)
+        block_indices = np.empty((n_blocks, k), np.int64)
+        block_sizes = np.empty(n_blocks, np.int64)
+        for b in prange(n_blocks):
+            block_sizes[b] = _heap_topk(
+                scores, ids, b * n // n_blocks, (b + 1) * n // n_blocks, k,
+                block_values[b], block_indices[b]
+            )
+
+        candidates = 0
+        for b in range(n_blocks):
+            candidates += block_sizes[b]
+        candidate_values = np.empty(candidates, scores.dtype)
+        candidate_indices = np.empty(candidates, np.int64)
+        pos = 0
+        for b in range(n_blocks):
+            for j in range(block_sizes[b]):
+                candidate_values[pos] = block_values[b, j]
+                candidate_indices[pos] = block_indices[b, j]
+                pos += 1
+
+        values = np.empty(k, scores.dtype)
+        indices = np.empty(k, np.int64)
+        _heap_topk(candidate_values, candidate_indices, 0, candidates, k, values, indices)
+        return indices[np.argsort(-values)]
+
+    # Compile for the score dtypes in use now instead of on the first request
+    for _dtype in (np.float32, np.float64):
+        _topk_serial(np.zeros(4, _dtype), 2)
+        _topk_numba(np.zeros(4, _dtype), 2, 1)
+
+def topk(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    # Numba has no float16, so other score dtypes take the NumPy path
+    if njit is None or k == len(scores) or scores.dtype not in (np.float32, np.float64):
+        return _topk_numpy(scores, k)
+    scores = np.ascontiguousarray(scores)
+    # Blocks must hold at least k scores so their heaps fill, and enough more
+    # that spreading them over threads outweighs the launch cost
+    n_blocks = max(1, min(get_num_threads(), len(scores) // max(k, MIN_BLOCK_SIZE)))
+    if n_blocks == 1:
+        return _topk_serial(scores, k)
+    return _topk_numba(scores, k, n_blocks)
@@ -1,6 +1,8 @@
 import os
-import json
+import orjson
 import uuid
+import asyncio
+from collections import defaultdict
 from datetime import datetime
 from typing import List, Dict, Optional, Any
 import aiofiles
@@ -15,11 +17,31 @@ class ChatHistory:
         """
         self.storage_dir = storage_dir
         os.makedirs(storage_dir, exist_ok=True)
+        # Serialize writers per session and keep loaded sessions in memory
+        self._locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._cache: Dict[str, List[Dict[str, Any]]] = {}
     
     def _get_session_path(self, session_id: str) -> str:
-        """Get file path for a session's chat history."""
+        """Get file path for a session's chat history (one JSON message per line)."""
+        return os.path.join(self.storage_dir, f"{session_id}.jsonl")
+    
+    def _get_legacy_session_path(self, session_id: str) -> str:
+        """Get file path for a session stored in the old single-document format."""
         return os.path.join(self.storage_dir, f"{session_id}.json")
     
+    async def _read_legacy_messages(self, session_id: str) -> List[Dict[str, Any]]:
+        """Read messages from an old-format session file, if one exists."""
+        file_path = self._get_legacy_session_path(session_id)
+        if not os.path.exists(file_path):
+            return []
+            
+        try:
+            async with aiofiles.open(file_path, 'rb') as f:
+                data = orjson.loads(await f.read())
+                return data.get("messages", [])
+        except (orjson.JSONDecodeError, FileNotFoundError):
+            return []
+    
     async def add_message(
         self,
         session_id: str,
@@ -50,14 +72,27 @@ class ChatHistory:
             "metadata": metadata or {}
         }
         
-        # Load existing messages or create new list
-        messages = await self.get_messages(session_id)
-        messages.append(message)
-        
-        # Save updated messages
-        file_path = self._get_session_path(session_id)
-        async with aiofiles.open(file_path, 'w') as f:
-            await f.write(json.dumps({"messages": messages}, indent=2))
+        async with self._locks[session_id]:
+            messages = self._cache.get(session_id)
+            if messages is None:
+                messages = await self._load_messages(session_id)
+            
+            file_path = self._get_session_path(session_id)
+            lines = [message]
+            if not os.path.exists(file_path):
+                # Carry over any history from the old format before the first append
+                lines = messages + lines
+            
+            # Append only the new message instead of rewriting the whole session
+            async with aiofiles.open(file_path, 'ab') as f:
+                await f.write(b"".join(orjson.dumps(m) + b"\n" for m in lines))
+            
+            legacy_path = self._get_legacy_session_path(session_id)
+            if len(lines) > 1 and os.path.exists(legacy_path):
+                os.remove(legacy_path)
+            
+            messages.append(message)
+            self._cache[session_id] = messages
             
         return message
     
@@ -71,17 +106,30 @@ class ChatHistory:
         Returns:
             List of message dictionaries
         """
+        if session_id not in self._cache:
+            async with self._locks[session_id]:
+                if session_id not in self._cache:
+                    self._cache[session_id] = await self._load_messages(session_id)
+        return list(self._cache[session_id])
+    
+    async def _load_messages(self, session_id: str) -> List[Dict[str, Any]]:
+        """Read a session's messages from disk."""
         file_path = self._get_session_path(session_id)
         if not os.path.exists(file_path):
-            return []
+            return await self._read_legacy_messages(session_id)
             
+        messages = []
         try:
-            async with aiofiles.open(file_path, 'r') as f:
-                content = await f.read()
-                data = json.loads(content)
-                return data.get("messages", [])
-        except (json.JSONDecodeError, FileNotFoundError):
+            async with aiofiles.open(file_path, 'rb') as f:
+                async for line in f:
+                    if line.strip():
+                        messages.append(orjson.loads(line))
+        except FileNotFoundError:
             return []
+        except orjson.JSONDecodeError:
+            # A torn final line from an interrupted append; keep what was read
+            pass
+        return messages
     
     async def clear_session(self, session_id: str) -> bool:
         """
@@ -93,11 +141,14 @@ class ChatHistory:
         Returns:
             True if successful, False otherwise
         """
-        file_path = self._get_session_path(session_id)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            return True
-        return False
+        async with self._locks[session_id]:
+            self._cache.pop(session_id, None)
+            removed = False
+            for file_path in (self._get_session_path(session_id), self._get_legacy_session_path(session_id)):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                    removed = True
+        return removed
     
     async def get_session_stats(self, session_id: str) -> Dict[str, Any]:
         """
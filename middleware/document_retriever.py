@@ -1,37 +1,143 @@
 try:
-    from elsai_retrievers.hybrid_retriever import HybridRetriever
+    from rank_bm25 import BM25Okapi
     from sentence_transformers import SentenceTransformer
+    import torch
     from typing import List, Dict, Any, Optional, Tuple
+    from functools import lru_cache
+    from collections import OrderedDict
+    import threading
+    import hashlib
     import numpy as np
     import logging
+    from _topk import topk
+
+    try:
+        import faiss
+    except ImportError:
+        faiss = None
+
+    try:
+        import simsimd
+    except ImportError:
+        simsimd = None
+
+    try:
+        from numba import njit, prange
+    except ImportError:
+        njit = None
     
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
+
+    # Corpora larger than this are indexed with HNSW instead of an exact flat scan
+    HNSW_THRESHOLD = 10000
+
+    # Chunks per forward pass when embedding documents
+    ENCODE_BATCH_SIZE = 128
+
+    # Chunk embeddings kept for re-uploads of identical text, least recently used evicted
+    EMB_CACHE_SIZE = 10000
+
+    def quantize_int8(vectors: np.ndarray) -> np.ndarray:
+        """Scale each row by its max component into int8, preserving direction."""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        scale = np.abs(vectors).max(axis=1, keepdims=True)
+        scale[scale == 0] = 1.0
+        return np.round(vectors * (127 / scale)).astype(np.int8)
+
+    def tokenize(text: str) -> List[str]:
+        """Lowercased whitespace tokens used for the BM25 index and queries."""
+        return text.lower().split()
+
+    if njit is not None:
+        @njit(parallel=True, fastmath=True, cache=True)
+        def _cosine_scores(embeddings, query):
+            """Cosine of each row against a unit-length query, rows scored in parallel."""
+            n, d = embeddings.shape
+            scores = np.empty(n, np.float32)
+            for i in prange(n):
+                dot = np.float32(0.0)
+                sq_norm = np.float32(0.0)
+                for j in range(d):
+                    value = np.float32(embeddings[i, j])
+                    dot += value * query[j]
+                    sq_norm += value * value
+                scores[i] = dot / np.sqrt(sq_norm) if sq_norm > 0 else np.float32(0.0)
+            return scores
     
     class DocumentRetriever:
         def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
-            """Initialize with HybridRetriever and embedding model."""
+            """Initialize with embedding model."""
             try:
                 logger.info("Initializing DocumentRetriever...")
-                self.hybrid_retriever = HybridRetriever()
-                logger.info("Initialized HybridRetriever")
                 self.embedding_model = SentenceTransformer(model_name)
+                if torch.cuda.is_available():
+                    # Half precision halves memory traffic and runs on tensor cores
+                    self.embedding_model = self.embedding_model.half().to('cuda')
                 logger.info(f"Loaded embedding model: {model_name}")
                 self.documents = []
                 self.document_embeddings = None
+                self.semantic_retriever = None
+                self.bm25 = None
+                # Embeddings keyed by SHA1 of the chunk text, shared across uploads;
+                # the lock covers encode_documents calls from concurrent worker threads
+                self._emb_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+                self._emb_cache_lock = threading.Lock()
+                self.encode_query = lru_cache(maxsize=1024)(self._encode_query)
                 logger.info("DocumentRetriever initialized successfully")
             except Exception as e:
                 logger.error(f"Initialization failed: {str(e)}", exc_info=True)
                 raise
 
-        def add_documents(self, chunks: List[str]):
-            """Add documents to the retriever."""
+        def encode_documents(self, texts: List[str]) -> np.ndarray:
+            """Encode texts, running the model only on content not seen before."""
+            keys = [hashlib.sha1(text.encode("utf-8")).digest() for text in texts]
+            found = {}
+            misses = {}
+            with self._emb_cache_lock:
+                for key, text in zip(keys, texts):
+                    if key in self._emb_cache:
+                        self._emb_cache.move_to_end(key)
+                        found[key] = self._emb_cache[key]
+                    else:
+                        misses.setdefault(key, text)
+
+            if misses:
+                logger.info(f"Encoding {len(misses)} new chunks ({len(texts) - len(misses)} cached)")
+                encoded = self.embedding_model.encode(
+                    list(misses.values()),
+                    batch_size=ENCODE_BATCH_SIZE,
+                    show_progress_bar=True,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+                found.update(zip(misses.keys(), encoded))
+                with self._emb_cache_lock:
+                    self._emb_cache.update(zip(misses.keys(), encoded))
+                    while len(self._emb_cache) > EMB_CACHE_SIZE:
+                        self._emb_cache.popitem(last=False)
+
+            return np.stack([found[key] for key in keys])
+
+        def _encode_query(self, query: str) -> np.ndarray:
+            """Encode a single query; wrapped in an LRU cache per instance."""
+            embedding = self.embedding_model.encode(
+                query,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+            embedding.setflags(write=False)
+            return embedding
+
+        def add_documents(self, chunks: List[str], embeddings: Optional[np.ndarray] = None):
+            """Add documents to the retriever, reusing precomputed embeddings if given."""
             if not chunks:
                 logger.warning("No chunks provided to add_documents")
                 return
 
             logger.info(f"Adding {len(chunks)} document chunks")
-            self.documents = [chunk.strip() for chunk in chunks if chunk.strip()]
+            keep = [i for i, chunk in enumerate(chunks) if chunk.strip()]
+            self.documents = [chunks[i].strip() for i in keep]
             
             if not self.documents:
                 logger.warning("No valid documents after cleaning")
@@ -40,14 +146,24 @@ try:
             logger.info(f"Processing {len(self.documents)} valid documents")
             
             try:
-                # Generate document embeddings
-                logger.info("Generating document embeddings...")
-                self.document_embeddings = self.embedding_model.encode(
-                    self.documents,
-                    show_progress_bar=True,
-                    convert_to_tensor=True
+                if embeddings is not None:
+                    # Kept as given (e.g. a memory-mapped store); SimpleRetriever reads it
+                    # into its own float32 copy when it builds the index
+                    self.document_embeddings = embeddings
+                    if len(keep) < len(chunks):
+                        self.document_embeddings = self.document_embeddings[keep]
+                else:
+                    # Generate document embeddings
+                    logger.info("Generating document embeddings...")
+                    self.document_embeddings = self.encode_documents(self.documents)
+                    logger.info(f"Generated embeddings for {len(self.documents)} documents")
+
+                # Build the semantic and BM25 indexes once per corpus instead of once per query
+                self.semantic_retriever = self.SimpleRetriever(
+                    documents=self.documents,
+                    embeddings=self.document_embeddings
                 )
-                logger.info(f"Generated embeddings for {len(self.documents)} documents")
+                self.bm25 = BM25Okapi([tokenize(doc) for doc in self.documents])
                 
             except Exception as e:
                 logger.error(f"Error processing documents: {str(e)}", exc_info=True)
@@ -57,19 +173,68 @@ try:
             """A simple retriever that uses cosine similarity for semantic search."""
             def __init__(self, documents, embeddings):
                 self.documents = documents
+                # Normalize once so cosine similarity is a plain inner product per query.
+                # Model output is already unit length, so it is used without a copy.
+                embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+                norms = np.sqrt(np.einsum('ij,ij->i', embeddings, embeddings))[:, None]
+                if not np.allclose(norms, 1.0, atol=1e-3):
+                    norms[norms == 0] = 1.0
+                    embeddings = embeddings / norms
                 self.embeddings = embeddings
+                self.index = None
+                if faiss is not None and len(self.embeddings):
+                    self.index = self._build_index(self.embeddings)
+                elif simsimd is not None or njit is not None:
+                    # int8 rows are 4x smaller; scored with SimSIMD's int8 cosine or a Numba kernel
+                    self.embeddings = quantize_int8(self.embeddings)
                 logger.info(f"Initialized SimpleRetriever with {len(documents)} documents")
+
+            @staticmethod
+            def _build_index(embeddings):
+                """Build a FAISS inner-product index over normalized embeddings."""
+                dim = embeddings.shape[1]
+                if len(embeddings) > HNSW_THRESHOLD:
+                    index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+                    index.hnsw.efConstruction = 200
+                    index.hnsw.efSearch = 64
+                else:
+                    index = faiss.IndexFlatIP(dim)
+                index.add(embeddings)
+                return index
+                
+            @staticmethod
+            def _normalize_query(query_embedding) -> np.ndarray:
+                """Copy the query into a unit-length (1, d) float32 row."""
+                query = np.array(query_embedding, dtype=np.float32).reshape(1, -1)
+                query /= np.sqrt(np.vdot(query, query))
+                return query
+
+            def score_all(self, query_embedding) -> np.ndarray:
+                """Cosine similarity of the query against every document."""
+                query = self._normalize_query(query_embedding)
+                if self.embeddings.dtype == np.int8 and simsimd is not None:
+                    return 1 - np.asarray(
+                        simsimd.cdist(quantize_int8(query), self.embeddings, metric="cosine")
+                    ).ravel()
+                elif self.embeddings.dtype == np.int8:
+                    return _cosine_scores(self.embeddings, query[0])
+                # Cosine similarity over unit vectors is a single matrix-vector product
+                return self.embeddings @ query[0]
                 
             def retrieve(self, query_embedding, k=5) -> Tuple[List[str], List[float]]:
                 """Retrieve documents based on cosine similarity."""
                 try:
-                    # Calculate cosine similarities
-                    scores = np.dot(self.embeddings, query_embedding) / (
-                        np.linalg.norm(self.embeddings, axis=1) * np.linalg.norm(query_embedding) + 1e-9
-                    )
-                    
-                    # Get top k results
-                    top_indices = np.argsort(scores)[-k:][::-1]
+                    if self.index is not None:
+                        query = self._normalize_query(query_embedding)
+                        distances, indices = self.index.search(query, min(k, len(self.documents)))
+                        hits = [(i, d) for i, d in zip(indices[0], distances[0]) if i != -1]
+                        results = [self.documents[i] for i, _ in hits]
+                        result_scores = [float(d) for _, d in hits]
+                        logger.debug(f"Retrieved {len(results)} documents with scores: {result_scores}")
+                        return results, result_scores
+
+                    scores = self.score_all(query_embedding)
+                    top_indices = topk(scores, k)
                     results = [self.documents[i] for i in top_indices]
                     result_scores = scores[top_indices].tolist()
                     
@@ -86,57 +251,44 @@ try:
             semantic_weight: float = 0.7,
             bm25_weight: float = 0.3
         ) -> List[Dict[str, Any]]:
-            """Retrieve documents using hybrid search with HybridRetriever."""
+            """Retrieve documents by a weighted sum of cosine and normalized BM25 scores."""
             logger.info(f"Retrieving documents for query: '{query}'")
             
-            if not self.documents or self.document_embeddings is None:
+            if not self.documents or self.semantic_retriever is None:
                 logger.warning("No documents or embeddings available for retrieval")
                 return []
 
             try:
                 # Get query embedding
                 logger.debug("Encoding query...")
-                query_embedding = self.embedding_model.encode(
-                    query, 
-                    convert_to_tensor=True
-                ).cpu().numpy()
+                query_embedding = self.encode_query(query)
                 logger.debug("Query encoded successfully")
                 
-                # Create a simple retriever for semantic search
-                logger.debug("Creating semantic retriever...")
-                semantic_retriever = self.SimpleRetriever(
-                    documents=self.documents,
-                    embeddings=self.document_embeddings.cpu().numpy()
-                )
-                
                 # Log document and query info
                 logger.info(f"Number of documents: {len(self.documents)}")
                 logger.info(f"Query: {query}")
                 logger.info(f"Query embedding shape: {query_embedding.shape}")
                 
-                # Perform hybrid retrieval
+                # Perform hybrid retrieval against the indexes built in add_documents
                 logger.debug("Performing hybrid retrieval...")
-                results = self.hybrid_retriever.hybrid_retrieve(
-                    chunks=self.documents,  # For BM25
-                    retrievers=[semantic_retriever],  # Our semantic retriever
-                    question=query
-                )
-                
-                logger.info(f"Raw results from hybrid_retrieve: {results}")
+                semantic_scores = self.semantic_retriever.score_all(query_embedding)
+                bm25_scores = self.bm25.get_scores(tokenize(query))
+                bm25_max = bm25_scores.max()
+                if bm25_max > 0:
+                    bm25_scores = bm25_scores / bm25_max
+                combined = semantic_weight * semantic_scores + bm25_weight * bm25_scores
                 
                 # Format results
-                formatted_results = []
-                if 'documents' in results and 'scores' in results:
-                    for doc, score in zip(results['documents'], results['scores']):
-                        formatted_results.append({
-                            "content": doc,
-                            "score": float(score),
-                            "semantic_score": float(score),
-                            "bm25_score": float(score)
-                        })
-                    logger.info(f"Formatted {len(formatted_results)} results")
-                else:
-                    logger.error(f"Unexpected results format: {results.keys()}")
+                formatted_results = [
+                    {
+                        "content": self.documents[i],
+                        "score": float(combined[i]),
+                        "semantic_score": float(semantic_scores[i]),
+                        "bm25_score": float(bm25_scores[i])
+                    }
+                    for i in topk(combined, top_k)
+                ]
+                logger.info(f"Formatted {len(formatted_results)} results")
                 
                 return formatted_results
                 
@@ -149,5 +301,5 @@ except ImportError as e:
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
     logger.error(f"Required packages not found: {str(e)}")
-    logger.error("Please install with: pip install elsai-retrievers sentence-transformers numpy")
+    logger.error("Please install with: pip install rank-bm25 sentence-transformers torch numpy faiss-cpu")
     raise
\ No newline at end of file
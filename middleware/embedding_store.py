@@ -0,0 +1,60 @@
+import os
+from typing import List
+
+import aiofiles
+import numpy as np
+from sqlalchemy.orm import Session
+
+from models import DocumentChunk, EMBEDDING_DTYPE
+
+class EmbeddingStore:
+    def __init__(self, path: str = "./embeddings.i8"):
+        """
+        Append-only file of packed embeddings, one row per DocumentChunk in id order.
+
+        Args:
+            path: File holding the concatenated embedding column bytes
+        """
+        self.path = path
+        self.itemsize = np.dtype(EMBEDDING_DTYPE).itemsize
+
+    def count(self, dim: int) -> int:
+        """Number of complete rows of the given dimension in the file."""
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (dim * self.itemsize)
+
+    def load(self, dim: int) -> np.ndarray:
+        """Memory-map the stored rows as an (N, dim) array without reading them."""
+        rows = self.count(dim)
+        if not rows:
+            return np.empty((0, dim), dtype=EMBEDDING_DTYPE)
+        return np.memmap(self.path, dtype=EMBEDDING_DTYPE, mode="r", shape=(rows, dim))
+
+    async def append(self, blobs: List[bytes]) -> None:
+        """Append packed embedding rows, in the order they were inserted."""
+        async with aiofiles.open(self.path, "ab") as f:
+            await f.write(b"".join(blobs))
+
+    def sync(self, db: Session) -> bool:
+        """
+        Rebuild the file from the database if their row counts disagree.
+
+        Args:
+            db: Session used to read the embedding column
+
+        Returns:
+            True if the file was rewritten, False if it was already consistent
+        """
+        rows = db.query(DocumentChunk.embedding, DocumentChunk.dim).order_by(DocumentChunk.id).all()
+        if rows and self.count(rows[0].dim) == len(rows):
+            return False
+        if not rows and not os.path.exists(self.path):
+            return False
+
+        # Write to a sibling file first so a crash never leaves a torn store
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(b"".join(row.embedding for row in rows))
+        os.replace(temp_path, self.path)
+        return True
@@ -1,24 +1,37 @@
 from fastapi import Depends, FastAPI, UploadFile, File, Form, HTTPException, Request, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import uvicorn
+import asyncio
+import hashlib
 import os
-import shutil
+import re
 import uuid
+import aiofiles
+import aiofiles.os
+import numpy as np
 from typing import Optional
 from dotenv import load_dotenv
 from sqlalchemy.orm import Session
-from database import get_db
-from models import DocumentChunk
+from database import SessionLocal, get_db
+from models import DocumentChunk, migrate_embeddings, pack_embedding
+from embedding_store import EmbeddingStore
 import logging
-import json
 
 # Import from textextraction_bckup to avoid duplicate code
 from textextraction_bckup import (
-    MistralOCR, 
-    chunk_text, 
-    ask_llm, 
+    extract_and_chunk,
+    query_batcher,
+    stream_claude_bedrock,
+    UPLOAD_BUFFER_BYTES,
+    make_upload_path,
+    MAX_TOKENS,
+    MAX_TOKENS_CEILING,
+    MISTRAL_API_KEY,
     get_blob_table_from_db,
-    documents,  # Using the global documents store from textextraction_bckup
+    DocState,
+    create_session,
+    get_session,  # Per-session documents, also registered by this app's /upload
     llm         # Using the configured Bedrock LLM from textextraction_bckup
 )
 
@@ -26,6 +39,7 @@ from textextraction_bckup import (
 from chat_history import ChatHistory
 
 from document_retriever import DocumentRetriever
+from response_cache import ResponseCache
 
 # Setup logger
 logging.basicConfig(level=logging.INFO)
@@ -33,6 +47,18 @@ logger = logging.getLogger("fastapi_app")
 
 retriever = DocumentRetriever()
 
+# Convert any chunks stored with JSON or float16 embeddings to int8 blobs
+migrated = migrate_embeddings()
+if migrated:
+    logger.info(f"Migrated {migrated} stored embeddings to binary format")
+
+# Contiguous copy of the embedding column, read as one array instead of decoded per row;
+# the retriever still makes its own float32 copy when it builds the index
+embedding_store = EmbeddingStore()
+with SessionLocal() as startup_db:
+    if embedding_store.sync(startup_db):
+        logger.info("Rebuilt embedding store from the database")
+
 # Load environment variables
 load_dotenv(override=True)
 
@@ -45,6 +71,13 @@ app = FastAPI()
 # Initialize chat history
 chat_history = ChatHistory()
 
+# Answers to previous questions, invalidated whenever a document is uploaded
+response_cache = ResponseCache()
+
+# Serializes the DB insert, embedding store update and retriever refresh of concurrent
+# uploads so the retriever's documents and embedding rows always line up
+upload_lock = asyncio.Lock()
+
 # Configure CORS for frontend access
 app.add_middleware(
     CORSMiddleware,
@@ -54,8 +87,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store for document chunks (temporary in-memory storage)
-stored_chunks = []
+# Markers of OCR object reprs that leak into chunks instead of document text
+_NON_TEXT_CHUNK = re.compile(r"OCRPageObj|image_annotation|dimensions=OCRPageDimensions")
+
+def is_text_chunk(chunk):
+    """Return True for chunks that hold real document text."""
+    return isinstance(chunk, str) and len(chunk.strip()) > 30 and _NON_TEXT_CHUNK.search(chunk) is None
 
 # @app.post("/upload")
 # async def store_chunks(chunks, embeddings, db: Session):
@@ -78,7 +115,7 @@ stored_chunks = []
 #             shutil.copyfileobj(file.file, buffer)
 
 #         # Run OCR on the saved file
-#         ocr = MistralOCR(file_path=temp_file, api_key=os.getenv("MISTRAL_API_KEY", "2mD9Ox4iMbRVfmfyL5lWrTY0PK3ITWQy"))
+#         ocr = MistralOCR(file_path=temp_file, api_key=MISTRAL_API_KEY)
 #         ocr_text = str(ocr.extract())
         
 #         # Store the full text in the documents store
@@ -115,20 +152,22 @@ async def upload(
     db: Session = Depends(get_db)
 ):
     """Handle file upload, extract text, create chunks, and store in DB"""
+    temp_file = None
     try:
         logger.info(f"Uploading file: {file.filename}")
         # Save uploaded file to temp
-        temp_file = f"temp_{file.filename}"
-        with open(temp_file, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        temp_file = make_upload_path(file.filename or "")
+        file_hash = hashlib.sha256()
+        async with aiofiles.open(temp_file, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_BUFFER_BYTES):
+                file_hash.update(chunk)
+                await buffer.write(chunk)
         logger.info(f"Saved file to {temp_file}")
 
-        # OCR extract
-        mistral_api_key = os.getenv("MISTRAL_API_KEY")
-        logger.info(f"MISTRAL_API_KEY is set: {bool(mistral_api_key)}")
+        # OCR extract and chunk, served from the OCR cache for files seen before
+        logger.info(f"MISTRAL_API_KEY is set: {bool(MISTRAL_API_KEY)}")
         try:
-            ocr = MistralOCR(file_path=temp_file, api_key=mistral_api_key)
-            ocr_text = str(ocr.extract())
+            ocr_text, raw_chunks = await extract_and_chunk(temp_file, file_hash.hexdigest(), MISTRAL_API_KEY)
             logger.info(f"OCR text length: {len(ocr_text)}")
         except Exception as ocr_error:
             logger.error(f"OCR extraction failed: {ocr_error}")
@@ -138,46 +177,61 @@ async def upload(
             logger.warning("No text extracted from document")
             raise HTTPException(status_code=400, detail="No text extracted from document")
 
-        # Chunk text
-        raw_chunks = chunk_text(ocr_text, max_tokens=1500)
         logger.info(f"Raw chunks count: {len(raw_chunks)}")
         # Filter out non-text chunks (metadata, OCR objects, etc.)
-        def is_text_chunk(chunk):
-            return isinstance(chunk, str) and len(chunk.strip()) > 30 and not any(x in chunk for x in ["OCRPageObj", "image_annotation", "dimensions=OCRPageDimensions"])
-        chunks = [chunk for chunk in raw_chunks if is_text_chunk(chunk)]
+        chunks = [chunk.strip() for chunk in raw_chunks if is_text_chunk(chunk)]
         logger.info(f"Filtered text chunks count: {len(chunks)}")
         if not chunks:
             logger.warning("No valid text chunks found in document after filtering")
             raise HTTPException(status_code=400, detail="No valid text chunks found in document. Please check the document content.")
-        embeddings = retriever.embedding_model.encode(chunks, convert_to_tensor=False)
+        # Model inference and index builds run in worker threads so /ask keeps being served
+        embeddings = await asyncio.to_thread(retriever.encode_documents, chunks)
         logger.info(f"Embeddings shape: {getattr(embeddings, 'shape', type(embeddings))}")
 
-        # Save chunks into DB
-        try:
-            for text, emb in zip(chunks, embeddings):
-                logger.info(f"Inserting chunk of length {len(text)} and embedding type {type(emb)}")
-                db_chunk = DocumentChunk(
-                    text=text,
-                    embedding=json.dumps(emb.tolist() if hasattr(emb, "tolist") else emb)
-                )
-                db.add(db_chunk)
-            db.commit()
-            logger.info(f"Saved {len(chunks)} chunks to DB")
-        except Exception as db_error:
-            logger.error(f"DB insert/commit failed: {db_error}")
-            raise HTTPException(status_code=500, detail=f"DB insert/commit failed: {db_error}")
-
-        # After saving to DB, load all chunks and embeddings from DB into retriever
-        all_chunks = db.query(DocumentChunk).all()
-        retriever.documents = [c.text for c in all_chunks]
-        retriever.document_embeddings = retriever.embedding_model.encode(retriever.documents, convert_to_tensor=True)
+        rows = [
+            {"text": text, "embedding": pack_embedding(emb), "dim": len(emb)}
+            for text, emb in zip(chunks, embeddings)
+        ]
+        dim = embeddings.shape[1]
+
+        async with upload_lock:
+            # Chunks uploaded earlier already have their embeddings in the embedding store
+            previous_texts = [row.text for row in db.query(DocumentChunk.text).order_by(DocumentChunk.id)]
+
+            # Save chunks into DB
+            try:
+                db.bulk_insert_mappings(DocumentChunk, rows)
+                db.commit()
+                logger.info(f"Saved {len(chunks)} chunks to DB")
+            except Exception as db_error:
+                logger.error(f"DB insert/commit failed: {db_error}")
+                raise HTTPException(status_code=500, detail=f"DB insert/commit failed: {db_error}")
+
+            # Append the new rows to the store; if it fell out of step with the
+            # DB (e.g. a crash after commit), rebuild it from the DB instead
+            if embedding_store.count(dim) == len(previous_texts):
+                await embedding_store.append([row["embedding"] for row in rows])
+            else:
+                embedding_store.sync(db)
+
+            # Refresh the retriever from the store instead of re-running the model,
+            # taking exactly one embedding row per document
+            all_texts = previous_texts + chunks
+            await asyncio.to_thread(retriever.add_documents, all_texts, embedding_store.load(dim)[:len(all_texts)])
+            response_cache.invalidate()
         logger.info(f"Retriever in-memory updated: {len(retriever.documents)} documents loaded.")
 
-        # Clean temp file
-        os.remove(temp_file)
+        # Keep this document on its own too, for the session-scoped debug routes
+        session_id = create_session(DocState(
+            text=ocr_text,
+            chunks=chunks,
+            embeddings=embeddings.astype(np.float16),
+            doc_hash=file_hash.hexdigest()
+        ))
 
         return {
             "message": "Document processed successfully",
+            "session_id": session_id,
             "chunks": len(chunks),
             "text_length": len(ocr_text)
         }
@@ -185,36 +239,38 @@ async def upload(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
     finally:
-        if 'temp_file' in locals() and os.path.exists(temp_file):
-            os.remove(temp_file)
+        if temp_file:
+            try:
+                await aiofiles.os.remove(temp_file)
+            except FileNotFoundError:
+                pass
 
 @app.post("/ask")
-async def ask_question(query: str = Form(...)):
+async def ask_question(query: str = Form(...), stream: bool = Form(False), max_tokens: int = Form(MAX_TOKENS, ge=1, le=MAX_TOKENS_CEILING)):
+    """Answer a question from the top retrieved chunks, optionally streamed as SSE."""
     try:
         logger.info(f"Received question: {query}")
         logger.info(f"Number of documents in retriever: {len(retriever.documents) if hasattr(retriever, 'documents') else 0}")
 
-        if not retriever.documents or retriever.document_embeddings is None:
+        if not retriever.documents or retriever.semantic_retriever is None:
             return {"answer": "No documents available. Please upload a document first."}
 
-        # Create an instance of SimpleRetriever
-        semantic_retriever = retriever.SimpleRetriever(
-            documents=retriever.documents,
-            embeddings=retriever.document_embeddings.cpu().numpy()
-        )
+        # Repeated or near-identical questions skip retrieval and the LLM call
+        query_embedding = await asyncio.to_thread(retriever.encode_query, query)
+        # Cached answers were generated with the default length limit
+        use_cache = not stream and max_tokens == MAX_TOKENS
+        cached = response_cache.get(query, query_embedding) if use_cache else None
+        if cached is not None:
+            logger.info("Answered from response cache")
+            return cached
 
-        # Perform retrieval
-        docs, scores = semantic_retriever.retrieve(
-            retriever.embedding_model.encode(query, convert_to_tensor=True).cpu().numpy(),
-            k=3
-        )
+        # Perform retrieval against the index built at upload time
+        docs, scores = retriever.semantic_retriever.retrieve(query_embedding, k=3)
 
         logger.info(f"Retrieved {len(docs)} documents")
         logger.info(f"Top retrieved chunks: {[doc[:100] for doc in docs]}")
 
         # Filter out non-text chunks (metadata, OCR objects, etc.)
-        def is_text_chunk(chunk):
-            return isinstance(chunk, str) and len(chunk.strip()) > 30 and not any(x in chunk for x in ["OCRPageObj", "image_annotation", "dimensions=OCRPageDimensions"])
         filtered_docs = [doc for doc in docs if is_text_chunk(doc)]
         filtered_scores = [score for doc, score in zip(docs, scores) if is_text_chunk(doc)]
         logger.info(f"Filtered top chunks: {[doc[:100] for doc in filtered_docs]}")
@@ -224,32 +280,40 @@ async def ask_question(query: str = Form(...)):
 
         # Concatenate top filtered chunks for context
         context = "\n---\n".join(filtered_docs)
-        prompt = f"You are an AI assistant. Use the following document excerpts to answer the user's question as specifically as possible.\n\nDocument Excerpts:\n{context}\n\nUser Question: {query}\n\nAnswer:"
-        answer = ask_llm(query, prompt)
+        if stream:
+            # Tokens are forwarded as they are generated; streamed answers are not cached
+            return StreamingResponse(stream_claude_bedrock(query, context, max_tokens), media_type="text/event-stream")
 
-        return {
+        answer = await query_batcher.ask(query, filtered_docs, max_tokens, scope=response_cache.corpus_version)
+
+        response = {
             "answer": answer,
             "context": context[:500] + "..." if len(context) > 500 else context,
             "score": filtered_scores[0] if filtered_scores else 0
         }
+        # Failed LLM calls raise before this point, so only real answers are cached
+        if use_cache and answer:
+            response_cache.put(query, query_embedding, response)
+        return response
 
     except Exception as e:
         logger.error(f"Error in ask_question: {str(e)}", exc_info=True)
         return {"error": "An error occurred while processing your question."}
         
 @app.get("/debug-simple-ask")
-async def debug_simple_ask(q: str = "what is this document about"):
+async def debug_simple_ask(session_id: str, q: str = "what is this document about"):
     """Simple debug endpoint to test document question answering."""
     try:
-        if not documents.get("text"):
+        doc = get_session(session_id)
+        if doc is None or not doc.text:
             return {"error": "No document uploaded"}
         
-        context = documents["text"]
+        context = doc.text
         
         # Very simple and direct prompt
         simple_prompt = f"Please summarize what this document is about in 2-3 sentences: {context[:2000]}"
         
-        response = llm.invoke([{"role": "user", "content": simple_prompt}])
+        response = await asyncio.to_thread(llm.invoke, [{"role": "user", "content": simple_prompt}])
         
         if isinstance(response, dict):
             answer = response.get('content', str(response))
@@ -266,13 +330,14 @@ async def debug_simple_ask(q: str = "what is this document about"):
         return {"error": str(e)}
 
 @app.get("/debug-document")
-async def debug_document():
+async def debug_document(session_id: str):
     """Debug endpoint to check document content."""
     try:
-        if not documents.get("text"):
+        doc = get_session(session_id)
+        if doc is None or not doc.text:
             return {"error": "No document uploaded"}
         
-        content = documents["text"]
+        content = doc.text
         return {
             "document_length": len(content),
             "first_500_chars": content[:500],
@@ -287,7 +352,7 @@ async def test_bedrock():
     """Test the Bedrock LLM connection and response format."""
     try:
         test_prompt = [{"role": "user", "content": "Hello, can you hear me?"}]
-        response = llm.invoke(test_prompt)
+        response = await asyncio.to_thread(llm.invoke, test_prompt)
         
         # Log the raw response for debugging
         print("Bedrock test response:", response)
@@ -1,9 +1,55 @@
-from sqlalchemy import Column, Integer, Text
-from database import Base
+import orjson
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import Column, Integer, LargeBinary, Text, inspect, text
+from database import Base, engine
+
+# Embeddings are persisted as packed int8 bytes (384 dims -> 384 bytes). Each
+# vector is scaled by its max component, which keeps its direction (all that
+# cosine retrieval needs) but not its magnitude.
+EMBEDDING_DTYPE = np.int8
+
+# Rows written before the int8 switch, keyed by bytes per component
+_LEGACY_DTYPES = {2: np.float16, 4: np.float32}
 
 class DocumentChunk(Base):
     __tablename__ = "document_chunks"
     
     id = Column(Integer, primary_key=True, index=True)
     text = Column(Text)
-    embedding = Column(Text)  # store JSON string for now
+    embedding = Column(LargeBinary)  # packed EMBEDDING_DTYPE vector
+    dim = Column(Integer)
+
+def pack_embedding(embedding) -> bytes:
+    """Quantize an embedding vector to int8 bytes for the embedding column."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    scale = np.abs(vector).max() or 1.0
+    return np.round(vector * (127 / scale)).astype(EMBEDDING_DTYPE).tobytes()
+
+def unpack_embedding(blob: bytes, dim: Optional[int] = None) -> np.ndarray:
+    """Deserialize an embedding column value into a float32 vector (direction only)."""
+    itemsize = len(blob) // dim if dim else np.dtype(EMBEDDING_DTYPE).itemsize
+    dtype = _LEGACY_DTYPES.get(itemsize, EMBEDDING_DTYPE)
+    return np.frombuffer(blob, dtype=dtype).astype(np.float32)
+
+def migrate_embeddings():
+    """One-shot rewrite of legacy JSON/float16 embeddings into int8 blobs."""
+    Base.metadata.create_all(bind=engine)
+    columns = {column["name"] for column in inspect(engine).get_columns(DocumentChunk.__tablename__)}
+    with engine.begin() as conn:
+        if "dim" not in columns:
+            conn.execute(text("ALTER TABLE document_chunks ADD COLUMN dim INTEGER"))
+        rows = conn.execute(
+            text(
+                "SELECT id, embedding, dim FROM document_chunks "
+                "WHERE typeof(embedding) = 'text' OR length(embedding) != dim"
+            )
+        ).fetchall()
+        for row_id, value, dim in rows:
+            vector = orjson.loads(value) if isinstance(value, str) else unpack_embedding(value, dim)
+            conn.execute(
+                text("UPDATE document_chunks SET embedding = :embedding, dim = :dim WHERE id = :id"),
+                {"embedding": pack_embedding(vector), "dim": len(vector), "id": row_id}
+            )
+    return len(rows)
@@ -0,0 +1,140 @@
+import asyncio
+import re
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+# Matches the "A<n>:" markers that open each numbered answer in a batch response
+_ANSWER_MARKER = re.compile(r"^\s*A(\d+)\s*:\s*", re.MULTILINE)
+
+class QueryBatcher:
+    def __init__(
+        self,
+        answer_fn: Callable[..., Awaitable[str]],
+        window: float = 0.025,
+        max_batch: int = 8,
+    ):
+        """
+        Micro-batcher that answers questions arriving close together in one LLM call.
+
+        Only questions asked with the same scope (the document or corpus they are
+        about) are batched together, so one user's excerpts never reach another's prompt.
+
+        Args:
+            answer_fn: Coroutine with the signature of ask_llm, called once per batch
+            window: Seconds to wait after the first question for others to join it
+            max_batch: Most questions combined into a single call
+        """
+        self.answer_fn = answer_fn
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+
+    async def ask(self, query: str, chunks: List[str], max_tokens: int, scope: Hashable) -> str:
+        """
+        Queue a question and wait for its answer.
+
+        Args:
+            query: The user's question
+            chunks: Document excerpts to answer from
+            max_tokens: Maximum number of tokens in this question's answer
+            scope: Identifies the document or corpus version the excerpts come from;
+                only questions with equal scopes share a call
+
+        Returns:
+            The answer to this question
+        """
+        # The queue and worker are bound to the running event loop, so start them lazily
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((scope, (query, chunks, max_tokens, future)))
+        return await future
+
+    async def _collect(self) -> None:
+        """Gather queued questions, split them by scope and hand each batch off for answering."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            by_scope = defaultdict(list)
+            for scope, item in batch:
+                by_scope[scope].append(item)
+
+            # Answer in the background so the next batch can start collecting
+            for items in by_scope.values():
+                task = asyncio.create_task(self._answer(items))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+
+    async def _answer_one(self, query: str, chunks: List[str], max_tokens: int) -> str:
+        """Answer a single question on its own."""
+        context = "\n---\n".join(chunks)
+        return await self.answer_fn(query, context, max_context_length=len(context), max_tokens=max_tokens)
+
+    async def _answer(self, batch: List[Tuple[str, List[str], int, asyncio.Future]]) -> None:
+        """Answer a batch with one numbered prompt and resolve each question's future."""
+        try:
+            if len(batch) == 1:
+                query, chunks, max_tokens, _ = batch[0]
+                answers = {1: await self._answer_one(query, chunks, max_tokens)}
+            else:
+                answers = await self._answer_batch(batch)
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for number, (*_, future) in enumerate(batch, start=1):
+            if not future.done():
+                future.set_result(answers[number])
+
+    async def _answer_batch(self, batch: List[Tuple[str, List[str], int, asyncio.Future]]) -> Dict[int, str]:
+        """Ask all questions in one call, re-asking any whose answer can't be found."""
+        # Share one context for the batch, keeping each excerpt once in first-seen order
+        context = "\n---\n".join(dict.fromkeys(chunk for _, chunks, _, _ in batch for chunk in chunks))
+        questions = "\n".join(f"Q{number}: {query}" for number, (query, *_) in enumerate(batch, start=1))
+        prompt = (
+            "Answer each of the following questions separately. Start each answer on a new "
+            "line with its number in the form A1:, A2:, and so on.\n"
+            f"{questions}"
+        )
+        response = await self.answer_fn(
+            prompt,
+            context,
+            max_context_length=len(context),
+            max_tokens=sum(max_tokens for _, _, max_tokens, _ in batch),
+        )
+        answers = _split_answers(response or "", len(batch))
+
+        missing = [number for number in range(1, len(batch) + 1) if number not in answers]
+        if missing:
+            retried = await asyncio.gather(*[self._answer_one(*batch[number - 1][:3]) for number in missing])
+            answers.update(zip(missing, retried))
+        return answers
+
+
+def _split_answers(response: str, count: int) -> Dict[int, str]:
+    """Split a numbered batch response into answers keyed by question number."""
+    markers = list(_ANSWER_MARKER.finditer(response))
+    answers = {}
+    for marker, following in zip(markers, markers[1:] + [None]):
+        number = int(marker.group(1))
+        end = following.start() if following else len(response)
+        answer = response[marker.end():end].strip()
+        if 1 <= number <= count and answer and number not in answers:
+            answers[number] = answer
+    return answers
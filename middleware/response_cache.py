@@ -0,0 +1,101 @@
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+class ResponseCache:
+    def __init__(self, similarity_threshold: float = 0.95, max_entries: int = 1024):
+        """
+        LRU cache of /ask responses for the current document corpus.
+
+        Args:
+            similarity_threshold: Minimum cosine similarity between query
+                embeddings for a cached answer to be reused
+            max_entries: Number of responses kept before the least recently
+                used one is evicted
+        """
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.corpus_version = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        """Empty the cache and the query embedding slots."""
+        # key -> (embedding slot or None, response), least recently used first
+        self._responses: "OrderedDict[bytes, Tuple[Optional[int], Dict[str, Any]]]" = OrderedDict()
+        self._embeddings: Optional[np.ndarray] = None
+        self._slot_keys: List[Optional[bytes]] = []
+        self._free_slots: List[int] = []
+
+    def _key(self, query: str) -> bytes:
+        """Hash a query together with the corpus version it was answered against."""
+        return hashlib.blake2b(f"{self.corpus_version}:{query}".encode("utf-8")).digest()
+
+    def invalidate(self) -> None:
+        """Drop all cached responses; call whenever the corpus changes."""
+        self.corpus_version += 1
+        self._reset()
+
+    def _hit(self, key: bytes) -> Dict[str, Any]:
+        """Mark an entry as recently used and return its response."""
+        self._responses.move_to_end(key)
+        return self._responses[key][1]
+
+    def get(self, query: str, query_embedding: Optional[np.ndarray] = None) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached response for the query.
+
+        Args:
+            query: The user's question
+            query_embedding: Unit-length embedding of the query, enabling
+                reuse of answers to near-identical questions
+
+        Returns:
+            The cached response, or None on a miss
+        """
+        key = self._key(query)
+        if key in self._responses:
+            return self._hit(key)
+        if query_embedding is None or not self._slot_keys:
+            return None
+
+        used = len(self._slot_keys)
+        scores = self._embeddings[:used] @ np.asarray(query_embedding, dtype=np.float32)
+        if self._free_slots:
+            scores[self._free_slots] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] >= self.similarity_threshold:
+            return self._hit(self._slot_keys[best])
+        return None
+
+    def put(self, query: str, query_embedding: Optional[np.ndarray], response: Dict[str, Any]) -> None:
+        """Store the response for the query under the current corpus version."""
+        key = self._key(query)
+        if key in self._responses:
+            self._hit(key)
+            return
+
+        if len(self._responses) >= self.max_entries:
+            _, (slot, _) = self._responses.popitem(last=False)
+            if slot is not None:
+                self._slot_keys[slot] = None
+                self._free_slots.append(slot)
+
+        slot = None
+        if query_embedding is not None:
+            slot = self._store_embedding(key, np.asarray(query_embedding, dtype=np.float32))
+        self._responses[key] = (slot, response)
+
+    def _store_embedding(self, key: bytes, embedding: np.ndarray) -> int:
+        """Place a query embedding in a free row of the preallocated matrix."""
+        if self._embeddings is None:
+            self._embeddings = np.zeros((self.max_entries, embedding.shape[0]), dtype=np.float32)
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._slot_keys[slot] = key
+        else:
+            slot = len(self._slot_keys)
+            self._slot_keys.append(key)
+        self._embeddings[slot] = embedding
+        return slot
@@ -1,25 +1,66 @@
 import os
 import json
+import orjson
+import asyncio
+import hashlib
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+import aiofiles
+import numpy as np
 from dotenv import load_dotenv
 import boto3
 from botocore.exceptions import ClientError
-from fastapi import FastAPI, UploadFile, Form
+from fastapi import FastAPI, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from elsai_utilities.splitters import DocumentChunker
 from elsai_ocr_extractors.mistral_ocr import MistralOCR
 from elsai_db.mysql import MySQLSQLConnector
 from elsai_model.bedrock import BedrockConnector
-# Load environment variables
-load_dotenv()
+from response_cache import ResponseCache
+from query_batcher import QueryBatcher
+from _topk import topk
+# Load environment variables; .env wins over the process environment, as fastAPI.py's
+# own load did when these settings were still read at call time
+load_dotenv(override=True)
 
 # Constants
-DEFAULT_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+# Prompt caching on Bedrock needs a cache-enabled Claude model
+DEFAULT_MODEL_ID = "us.anthropic.claude-3-7-sonnet-20250219-v1:0"
+SYSTEM_INSTRUCTIONS = (
+    "You are a helpful assistant. Use the document excerpts provided to answer "
+    "the user's question as specifically as possible."
+)
 
-# Config
+# Config, read once at import
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+AWS_SESSION_TOKEN = os.getenv("AWS_SESSION_TOKEN")
+MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+DB_URL = os.getenv("DB_URL", "localhost")
+DB_USER = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "root")
+DB_NAME = os.getenv("DB_NAME", "document_store")
 MODEL_ID = os.getenv("MODEL_ID", DEFAULT_MODEL_ID)
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
-MAX_TOKENS = int(os.getenv("MAX_TOKENS", 500))
+MAX_TOKENS = int(os.getenv("MAX_TOKENS", 200))
+MAX_TOKENS_CEILING = int(os.getenv("MAX_TOKENS_CEILING", 1000))
 TEMPERATURE = float(os.getenv("TEMPERATURE", 0.1))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+UPLOAD_BUFFER_BYTES = int(os.getenv("UPLOAD_BUFFER_BYTES", 1 << 20))
+TOP_K_CHUNKS = int(os.getenv("TOP_K_CHUNKS", 4))
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "./ocr_cache")
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1500))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))
+BEDROCK_MAX_CONCURRENCY = int(os.getenv("BEDROCK_MAX_CONCURRENCY", 8))
+MAX_MAP_CHUNKS = int(os.getenv("MAX_MAP_CHUNKS", 16))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", 100))
+BATCH_WINDOW_SECONDS = float(os.getenv("BATCH_WINDOW_SECONDS", 0.025))
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", 8))
 
 messages = [{
     "role": "user",
@@ -28,9 +69,9 @@ messages = [{
 
 # Initialize BedrockConnector with LLM configuration
 llm = BedrockConnector(
-    aws_access_key=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-    aws_region=os.getenv('AWS_REGION'),
+    aws_access_key=AWS_ACCESS_KEY_ID,
+    aws_secret_key=AWS_SECRET_ACCESS_KEY,
+    aws_region=AWS_REGION,
     model_id=MODEL_ID,
     max_tokens=MAX_TOKENS,
     temperature=TEMPERATURE
@@ -51,125 +92,358 @@ app.add_middleware(
 # Bedrock client
 def create_bedrock_client():
     session = boto3.Session(
-        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-        aws_session_token=os.getenv("AWS_SESSION_TOKEN", None),
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        aws_session_token=AWS_SESSION_TOKEN,
         region_name=AWS_REGION,
     )
     return session.client("bedrock-runtime")
 
 bedrock_client = create_bedrock_client()
 
-# In-memory store
-documents = {"text": ""}
-stored_chunks = []  # Store document chunks for processing
+@dataclass
+class DocState:
+    """An uploaded document and everything derived from it for answering questions."""
+    text: str
+    chunks: List[str]
+    embeddings: Optional[np.ndarray]  # Unit-length float16 [N, d] embeddings of chunks
+    doc_hash: str
+    # Answers to questions about this document only, kept small since there is one per session
+    response_cache: ResponseCache = field(default_factory=lambda: ResponseCache(max_entries=128))
+
+
+# In-memory store of uploaded documents by session id, least recently used first
+sessions: "OrderedDict[str, DocState]" = OrderedDict()
+
+
+def get_session(session_id: str) -> Optional[DocState]:
+    """Return the document for a session, marking it as recently used."""
+    doc = sessions.get(session_id)
+    if doc is not None:
+        sessions.move_to_end(session_id)
+    return doc
+
+
+def create_session(doc: DocState) -> str:
+    """Register an uploaded document under a new session id, evicting the oldest beyond MAX_SESSIONS."""
+    session_id = uuid.uuid4().hex
+    sessions[session_id] = doc
+    while len(sessions) > MAX_SESSIONS:
+        sessions.popitem(last=False)
+    return session_id
+
+# Local sentence-transformer, loaded at app startup (or on first use outside the app)
+embedding_model = None
+embedding_model_lock = threading.Lock()
+
+
+def load_embedding_model():
+    """Return the local sentence-transformer, loading it once."""
+    global embedding_model
+    with embedding_model_lock:
+        if embedding_model is None:
+            from sentence_transformers import SentenceTransformer
+            embedding_model = SentenceTransformer(EMBEDDING_MODEL)
+    return embedding_model
+
+
+def embed_texts(texts):
+    """
+    Embed text(s) as unit-length vectors with the local sentence-transformer.
+    
+    This is CPU-bound; async handlers call it through asyncio.to_thread so
+    encoding never blocks the event loop.
+    """
+    return load_embedding_model().encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+
+
+def select_chunks(doc: DocState, query_embedding, k: int = TOP_K_CHUNKS):
+    """Return the k chunks of the document most similar to the query, best first."""
+    if doc.embeddings is None or not len(doc.chunks):
+        return [doc.text]
 
+    # Half-precision rows are accumulated in float32 without a full-size upcast copy
+    scores = np.einsum("ij,j->i", doc.embeddings, query_embedding, dtype=np.float32)
+    return [doc.chunks[i] for i in topk(scores, k)]
 
-def chunk_text(text: str, max_tokens: int = 2000):
+
+def make_upload_path(filename: str) -> str:
+    """
+    Create an empty, uniquely named temp file for an upload and return its path.
+    
+    Only the extension of the client's filename is kept, so it can't choose
+    the location or collide with another upload.
+    
+    Args:
+        filename (str): Filename sent by the client
+        
+    Returns:
+        str: Path of the new file, which the caller must remove
+    """
+    with tempfile.NamedTemporaryFile(prefix="upload_", suffix=os.path.splitext(filename)[1], delete=False) as f:
+        return f.name
+
+
+# Shared chunker, built once; the lock guards it in case chunk_text runs in worker threads
+chunker = DocumentChunker()
+chunker_lock = threading.Lock()
+
+
+def chunk_text(text: str):
     """Split extracted text into chunks for LLM context."""
-    chunker = DocumentChunker()
-    chunks = chunker.chunk_recursive(
-        contents=text,
-        file_name="ocr_text.txt",
-        chunk_size=max_tokens,
-        chunk_overlap=200,
-    )
+    with chunker_lock:
+        chunks = chunker.chunk_recursive(
+            contents=text,
+            file_name="ocr_text.txt",
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+        )
     return [chunk.page_content for chunk in chunks]
 
 
-def invoke_claude_bedrock(prompt: str):
-    """Send prompt to Claude model via AWS Bedrock."""
+async def extract_and_chunk(file_path: str, file_hash: str, api_key: str):
+    """
+    Run OCR and chunking on a file, reusing the result for content seen before.
+    
+    Args:
+        file_path (str): Path of the uploaded file
+        file_hash (str): Hex SHA-256 of the file's bytes, used as the cache key
+        api_key (str): Mistral API key for the OCR call
+        
+    Returns:
+        tuple: The extracted text and its chunks
+    """
+    # Chunk settings are part of the key so changing them never serves stale chunks
+    cache_path = os.path.join(OCR_CACHE_DIR, f"{file_hash}-{CHUNK_SIZE}-{CHUNK_OVERLAP}.json")
+    if os.path.exists(cache_path):
+        async with aiofiles.open(cache_path, "r") as f:
+            cached = json.loads(await f.read())
+        return cached["text"], cached["chunks"]
+
+    # OCR and chunking take seconds to minutes, so they run in worker threads
+    # to keep the event loop serving other requests meanwhile
+    text = await asyncio.to_thread(lambda: MistralOCR(file_path=file_path, api_key=api_key).extract())
+    # Only convert when the extractor hands back a non-string result
+    if not isinstance(text, str):
+        text = str(text)
+    chunks = await asyncio.to_thread(chunk_text, text)
+
+    # Write to a uniquely named temp file first so readers never see a partial entry
+    # and concurrent uploads of the same file never share one
+    os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=OCR_CACHE_DIR, suffix=".tmp")
+    os.close(fd)
     try:
-        body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": MAX_TOKENS,
-            "temperature": TEMPERATURE,
-            "messages": [{"role": "user", "content": prompt}],
-        }
+        async with aiofiles.open(temp_path, "w") as f:
+            await f.write(json.dumps({"text": text, "chunks": chunks}))
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return text, chunks
+
+
+# The parts of the request body that never change, serialized once at import;
+# only max_tokens, the context and the question are encoded per request
+_BODY_HEAD = orjson.dumps({
+    "anthropic_version": "bedrock-2023-05-31",
+    "temperature": TEMPERATURE,
+})[:-1] + b',"max_tokens":'
+# The instructions are the only prefix shared by every call, so the cache checkpoint
+# goes on them; the excerpts differ per question and would only pay the cache-write premium
+_SYSTEM_HEAD = b',"system":[' + orjson.dumps({
+    "type": "text",
+    "text": SYSTEM_INSTRUCTIONS,
+    "cache_control": {"type": "ephemeral"},
+})
+_CONTEXT_HEAD = b',{"type":"text","text":'
+_MESSAGES_HEAD = b'],"messages":[{"role":"user","content":'
+_BODY_TAIL = b'}]}'
+
+
+def build_claude_body(query: str, context: str = None, max_tokens: int = MAX_TOKENS):
+    """
+    Serialize the Bedrock messages request body for a question.
+    
+    The instructions and document context go in the system prompt. Only the
+    instructions carry a prompt-cache checkpoint: the context is each question's
+    own excerpts, which rarely recur, so caching it would cost more than it saves.
+    
+    Args:
+        query (str): The user's question, the only part that varies per call
+        context (str): Document context to answer from, if any
+        max_tokens (int): Answer length limit, clamped to 1..MAX_TOKENS_CEILING
+        
+    Returns:
+        bytes: The JSON request body
+    """
+    parts = [_BODY_HEAD, b"%d" % max(1, min(max_tokens, MAX_TOKENS_CEILING)), _SYSTEM_HEAD]
+    if context:
+        parts += [_CONTEXT_HEAD, orjson.dumps(f"Document Context:\n{context}"), b"}"]
+    parts += [_MESSAGES_HEAD, orjson.dumps(query), _BODY_TAIL]
+    return b"".join(parts)
+
 
-        response = bedrock_client.invoke_model(
+class BedrockError(Exception):
+    """A Bedrock call failed or returned no answer."""
+
+
+async def invoke_claude_bedrock(query: str, context: str = None, max_tokens: int = MAX_TOKENS):
+    """
+    Send a question to Claude via AWS Bedrock without blocking the event loop.
+    
+    Raises:
+        BedrockError: If the call fails or the response holds no text, so
+            callers never mistake an error message for an answer
+    """
+    try:
+        response = await asyncio.to_thread(
+            bedrock_client.invoke_model,
             modelId=MODEL_ID,
-            body=json.dumps(body),
+            body=build_claude_body(query, context, max_tokens),
             contentType="application/json",
         )
-        response_body = json.loads(response["body"].read())
+        response_body = orjson.loads(await asyncio.to_thread(response["body"].read))
 
         texts = [
             item["text"]
             for item in response_body.get("content", [])
             if item.get("type") == "text"
         ]
-        return "\n".join(texts) if texts else None
+    except ClientError as e:
+        raise BedrockError(f"AWS ClientError: {e.response['Error']['Message']}") from e
+    except Exception as e:
+        raise BedrockError(f"Error calling Bedrock: {e}") from e
+
+    if not texts:
+        raise BedrockError("No response received from the AI model.")
+    return "\n".join(texts)
+
+
+async def stream_claude_bedrock(query: str, context: str = None, max_tokens: int = MAX_TOKENS):
+    """
+    Stream Claude's answer from AWS Bedrock as Server-Sent Events.
+
+    The blocking boto3 call and event reads run in worker threads so the
+    event loop keeps serving other requests while tokens arrive.
+
+    Args:
+        query (str): The user's question
+        context (str): Document context to answer from, if any
+        max_tokens (int): Answer length limit, capped at MAX_TOKENS_CEILING
+
+    Yields:
+        bytes: ``data:`` lines carrying ``{"text": ...}`` deltas, then ``[DONE]``
+    """
+    try:
+        response = await asyncio.to_thread(
+            bedrock_client.invoke_model_with_response_stream,
+            modelId=MODEL_ID,
+            body=build_claude_body(query, context, max_tokens),
+            contentType="application/json",
+        )
+        events = iter(response["body"])
+        while (event := await asyncio.to_thread(next, events, None)) is not None:
+            chunk = orjson.loads(event["chunk"]["bytes"])
+            if chunk.get("type") == "content_block_delta" and chunk["delta"].get("type") == "text_delta":
+                yield b"data: " + orjson.dumps({"text": chunk["delta"]["text"]}) + b"\n\n"
 
     except ClientError as e:
-        return f" AWS ClientError: {e.response['Error']['Message']}"
+        yield b"data: " + orjson.dumps({"error": e.response["Error"]["Message"]}) + b"\n\n"
     except Exception as e:
-        return f" Error calling Bedrock: {e}"
+        yield b"data: " + orjson.dumps({"error": f"Error calling Bedrock: {e}"}) + b"\n\n"
+    yield b"data: [DONE]\n\n"
 
 
-def ask_llm(query, context, max_context_length=4000):
+def truncate_context(context, max_context_length=4000):
+    """Truncate the context if needed to avoid token limits."""
+    if len(context) > max_context_length:
+        return context[:max_context_length] + "... [truncated]"
+    return context
+
+
+async def ask_llm(query, context, max_context_length=4000, max_tokens=MAX_TOKENS):
     """
     Send a query to the LLM with the provided context.
     
+    The context goes in the system prompt after the shared instructions,
+    which are the cached part of the prompt.
+    
     Args:
         query (str): The user's question
         context (str): The context to use for answering the question
         max_context_length (int): Maximum number of characters to include from context
+        max_tokens (int): Maximum number of tokens in the answer
         
     Returns:
         str: The LLM's response
+        
+    Raises:
+        BedrockError: If the LLM call fails
     """
-    try:
-        # Truncate context if needed to avoid token limits
-        if len(context) > max_context_length:
-            context = context[:max_context_length] + "... [truncated]"
-            
-        # Prepare the prompt with context and question
-        prompt = f"""
-        You are a helpful assistant. Use the following document excerpts to answer the question.
-    
-        Document Context:
-        {context}
+    return await invoke_claude_bedrock(query, truncate_context(context, max_context_length), max_tokens)
+
+
+# Caps concurrent Bedrock calls from fan-out requests to avoid throttling
+bedrock_semaphore = asyncio.Semaphore(BEDROCK_MAX_CONCURRENCY)
+
+
+async def ask_llm_map_reduce(query, chunks, max_tokens=MAX_TOKENS):
+    """
+    Answer a question over every chunk concurrently, then merge the answers.
     
-        Question: {query}
+    Each chunk is sent to the LLM as its own context (map); the partial
+    answers are then combined in a final call (reduce). Independent calls
+    overlap, so latency is that of the slowest call rather than their sum.
     
-        Answer:
-        """
-        response = llm.invoke([{"role": "user", "content": prompt}])
-       # ✅ unwrap different possible response formats
-        if isinstance(response, dict):
-            if "choices" in response:
-                return response["choices"][0]["message"]["content"]
-            elif "content" in response:
-                return response["content"]
-            return str(response)
-        elif hasattr(response, "content"):
-            return response.content
-        return str(response)
-        # Prepare the message in the format expected by the Bedrock LLM
-        message = {
-            "role": "user",
-            "content": prompt
-        }
-        
-        # Use the global llm instance (BedrockConnector)
-        response = llm.invoke([message])
-        
-        # Process the response
-        if not response:
-            return "Error: No response received from the AI model."
-            
-        # Extract the answer from the response
-        answer = response.get('content', '').strip() if isinstance(response, dict) else str(response)
+    Args:
+        query (str): The user's question
+        chunks (list): Document chunks to answer from
+        max_tokens (int): Maximum number of tokens in each answer
         
-        if not answer or answer.lower() == "i don't know" or "not enough information" in answer.lower():
-            return "I couldn't find enough information in the document to answer that question."
-            
-        return answer
+    Returns:
+        str: The merged answer
         
-    except Exception as e:
-        print(f"Error in ask_llm: {e}")
-        return f"Error processing your request: {str(e)}"
+    Raises:
+        BedrockError: If every chunk's call fails, or the final merge fails
+    """
+    async def answer_chunk(chunk):
+        async with bedrock_semaphore:
+            return await ask_llm(query, chunk, max_context_length=len(chunk), max_tokens=max_tokens)
+
+    results = await asyncio.gather(*[answer_chunk(chunk) for chunk in chunks], return_exceptions=True)
+    # Tolerate failed chunks as long as some succeeded
+    partials = [answer for answer in results if not isinstance(answer, BaseException) and answer.strip()]
+    failures = [error for error in results if isinstance(error, BaseException)]
+    if failures:
+        print(f"Map-reduce: {len(failures)} of {len(results)} chunk calls failed: {failures[0]}")
+    if not partials:
+        if failures and len(failures) == len(results):
+            raise BedrockError(f"All {len(results)} chunk calls failed: {failures[0]}")
+        return "I couldn't find enough information in the document to answer that question."
+    if len(partials) == 1:
+        return partials[0]
+
+    combined = "\n---\n".join(partials)
+    return await ask_llm(
+        f"{query}\n\nThe excerpts below are partial answers drawn from different parts of the document; combine them into one answer.",
+        combined,
+        max_context_length=len(combined),
+        max_tokens=max_tokens
+    )
+
+
+# Questions arriving within a short window share one Bedrock call
+query_batcher = QueryBatcher(ask_llm, window=BATCH_WINDOW_SECONDS, max_batch=BATCH_MAX_QUERIES)
+
+
+@app.on_event("startup")
+async def load_models():
+    """Load the embedding model before serving so no request pays for it."""
+    await asyncio.to_thread(load_embedding_model)
 
 
 @app.post("/upload")
@@ -177,44 +451,53 @@ async def upload_file(file: UploadFile):
     """
     Handle file upload and text extraction.
     
+    Each upload starts a new session; its id must be sent with /ask.
+    
     Args:
         file (UploadFile): The uploaded file to process
         
     Returns:
-        dict: A dictionary with the processing results or error message
+        dict: A dictionary with the session id and processing results, or error message
     """
     if not file.filename:
         raise HTTPException(status_code=400, detail="No file provided")
+    if not MISTRAL_API_KEY:
+        raise HTTPException(status_code=500, detail="MISTRAL_API_KEY is not configured")
     
     temp_file = None
     try:
-        # Create a temporary file with a unique name
-        import tempfile
-        temp_file = f"{tempfile.gettempdir()}/upload_{file.filename}"
+        temp_file = make_upload_path(file.filename or "")
         
-        # Save uploaded file to the temporary location
-        with open(temp_file, "wb") as f:
-            f.write(await file.read())
-
-        # Run OCR on the saved file
-        ocr = MistralOCR(
-            file_path=temp_file, 
-            api_key=os.getenv("MISTRAL_API_KEY", "2mD9Ox4iMbRVfmfyL5lWrTY0PK3ITWQy")
+        # Stream the upload to disk in fixed-size chunks to keep memory flat,
+        # hashing it on the way so repeat uploads can skip OCR
+        file_hash = hashlib.sha256()
+        async with aiofiles.open(temp_file, "wb") as f:
+            while chunk := await file.read(UPLOAD_BUFFER_BYTES):
+                file_hash.update(chunk)
+                await f.write(chunk)
+
+        # Run OCR on the saved file and extract text and chunks
+        doc_hash = file_hash.hexdigest()
+        full_text, chunks = await extract_and_chunk(
+            temp_file,
+            doc_hash,
+            MISTRAL_API_KEY
         )
         
-        # Extract text and store it
-        full_text = str(ocr.extract())
-        documents["text"] = full_text
-        
-        # Also store chunks for backward compatibility
-        global stored_chunks
-        stored_chunks = chunk_text(full_text, max_tokens=1500)
+        # Embed the chunks once so /ask can select relevant context
+        session_id = create_session(DocState(
+            text=full_text,
+            chunks=chunks,
+            embeddings=(await asyncio.to_thread(embed_texts, chunks)).astype(np.float16) if chunks else None,
+            doc_hash=doc_hash
+        ))
         
         return {
             "message": "File processed successfully",
+            "session_id": session_id,
             "filename": file.filename,
             "text_length": len(full_text),
-            "chunks": len(stored_chunks)
+            "chunks": len(chunks)
         }
         
     except Exception as e:
@@ -226,62 +509,122 @@ async def upload_file(file: UploadFile):
         
     finally:
         # Clean up the temporary file
-        if temp_file and os.path.exists(temp_file):
+        if temp_file:
             try:
                 os.remove(temp_file)
+            except FileNotFoundError:
+                pass
             except OSError as e:
                 print(f"Warning: Could not remove temporary file {temp_file}: {e}")
 
 
 @app.post("/ask")
-async def ask_question(query: str = Form(...)):
+async def ask_question(
+    query: str = Form(...),
+    session_id: str = Form(...),
+    stream: bool = Form(False),
+    map_reduce: bool = Form(False),
+    max_tokens: int = Form(MAX_TOKENS, ge=1, le=MAX_TOKENS_CEILING)
+):
     """
     Answer a question based on the uploaded document using the Bedrock LLM.
     
     Args:
         query (str): The user's question
+        session_id (str): Session returned by /upload for the document to ask about
+        stream (bool): Stream the answer as Server-Sent Events instead of JSON
+        map_reduce (bool): Answer over the MAX_MAP_CHUNKS (default 16) most
+            relevant chunks in parallel, one LLM call each plus a merge call,
+            instead of one call over the top TOP_K_CHUNKS
+        max_tokens (int): Maximum answer length; short answers return sooner
         
     Returns:
         dict: A dictionary containing the answer and context used, or an error message
     """
     try:
-        if not documents.get("text"):
-            return {"error": "No document has been uploaded yet. Please upload a document first."}
+        doc = get_session(session_id)
+        if doc is None or not doc.text:
+            return {"error": "No document has been uploaded for this session. Please upload a document first."}
+
+        query_embedding = await asyncio.to_thread(embed_texts, query)
+
+        if map_reduce:
+            # Bounded so one request can't fan out into a call per chunk of a long document
+            chunks = select_chunks(doc, query_embedding, MAX_MAP_CHUNKS)
+            answer = await ask_llm_map_reduce(query, chunks, max_tokens)
+            return {"answer": answer, "chunks_used": len(chunks)}
 
-        # Get the document text as context
-        context = documents["text"]
+        # Repeated or near-identical questions about this document skip the LLM
+        # Cached answers were generated with the default length limit
+        use_cache = not stream and max_tokens == MAX_TOKENS
+        cached = doc.response_cache.get(query, query_embedding) if use_cache else None
+        if cached is not None:
+            return cached
+
+        # Use the chunks most similar to the question as context; the selection
+        # already bounds its size, so it is not truncated further
+        relevant_chunks = select_chunks(doc, query_embedding)
+        context = "\n---\n".join(relevant_chunks)
+
+        if stream:
+            # Streamed answers bypass the response cache
+            return StreamingResponse(
+                stream_claude_bedrock(query, context, max_tokens),
+                media_type="text/event-stream"
+            )
         
-        # Use the ask_llm function to get the answer
-        answer = ask_llm(query, context)
+        # Bursts of questions are answered together in one LLM call
+        answer = await query_batcher.ask(query, relevant_chunks, max_tokens, scope=session_id)
         
         # Prepare the response
-        return {
-           "answer": answer,
-           "session_id": session_id,
-           "context_used": filtered_docs
+        response = {
+            "answer": answer,
+            "context_used": relevant_chunks
         }
+        # Failed LLM calls raise before this point, so only real answers are cached
+        if use_cache and answer:
+            doc.response_cache.put(query, query_embedding, response)
+        return response
         
     except Exception as e:
         error_msg = f"Error processing your question: {str(e)}"
         print(error_msg)
         return {"error": error_msg}
 
+# MySQL connection pool, created on first use
+db_pool = None
+db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """Return the shared MySQL connection pool, creating it on first use."""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            import pymysql
+            from pymysql.cursors import DictCursor
+            from dbutils.pooled_db import PooledDB
+            
+            # Get database connection parameters from environment variables
+            db_pool = PooledDB(
+                creator=pymysql,
+                mincached=2,
+                maxcached=10,
+                host=DB_URL,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                database=DB_NAME,
+                cursorclass=DictCursor
+            )
+    return db_pool
+
+
 def get_blob_table_from_db():
     try:
         import pymysql
-        from pymysql.cursors import DictCursor
-        
-        # Get database connection parameters from environment variables
-        db_config = {
-            'host': os.getenv("DB_URL", "localhost"),
-            'user': os.getenv("DB_USER", "root"),
-            'password': os.getenv("DB_PASSWORD", "root"),
-            'database': os.getenv("DB_NAME", "document_store"),
-            'cursorclass': DictCursor
-        }
         
-        # Connect to the database
-        connection = pymysql.connect(**db_config)
+        # Borrow a pooled connection instead of a fresh TCP + auth handshake
+        connection = get_db_pool().connection()
         
         try:
             with connection.cursor() as cursor:
@@ -303,12 +646,12 @@ def get_blob_table_from_db():
             raise RuntimeError(f"Unexpected error during database operation: {e}")
             
         finally:
-            # Ensure the connection is closed
+            # Return the connection to the pool
             if connection:
                 connection.close()
                 
     except ImportError as e:
-        raise ImportError("pymysql package is required for database operations. Install it with: pip install pymysql") from e
+        raise ImportError("pymysql and DBUtils packages are required for database operations. Install them with: pip install pymysql DBUtils") from e
     except Exception as e:
         raise RuntimeError(f" Error fetching BLOB table: {e}") from e
 